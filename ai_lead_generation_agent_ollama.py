@@ -1,13 +1,19 @@
 import streamlit as st
-import requests
+import httpx
 from agno.agent import Agent
 from agno.tools.firecrawl import FirecrawlTools
 from agno.models.ollama import Ollama
-from firecrawl import FirecrawlApp
-from pydantic import BaseModel, Field
-from typing import List
+from firecrawl import AsyncV1FirecrawlApp, V1FirecrawlApp
+from pydantic import BaseModel, Field, ValidationError
+from typing import AsyncIterator, Iterator, List, Tuple
+import asyncio
+import io
 import json
+import time
+import hashlib
+from urllib.parse import urlsplit, urlunsplit
 import pandas as pd
+from diskcache import Cache
 
 class QuoraUserInteractionSchema(BaseModel):
     username: str = Field(description="The username of the user who posted the question or answer")
@@ -20,140 +26,318 @@ class QuoraUserInteractionSchema(BaseModel):
 class QuoraPageSchema(BaseModel):
     interactions: List[QuoraUserInteractionSchema] = Field(description="List of all user interactions (questions and answers) on the page")
 
+# Loop-invariant extract inputs, built once at import instead of per URL
+QUORA_PAGE_SCHEMA = QuoraPageSchema.model_json_schema()
+
+EXTRACT_PROMPT = (
+    "Extract all user information including username, bio, post type (question/answer), timestamp, upvotes, "
+    "and any links from Quora posts. Focus on identifying potential leads who are asking questions or providing "
+    "answers related to the topic."
+)
+
+# Firecrawl search/extract results are cached on disk so repeated runs skip the network
+# and don't spend API quota; entries expire so stale Quora content eventually refreshes.
+CACHE_TTL = 24 * 60 * 60
+
+@st.cache_resource
+def get_firecrawl_cache() -> Cache:
+    """Open the on-disk cache once per process; Streamlit re-executes this module on every rerun."""
+    return Cache(".firecrawl_cache")
+
+def _cache_key(*parts) -> str:
+    return hashlib.blake2b(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+
+# Changing the prompt or schema starts a fresh set of extract cache entries
+_EXTRACT_CACHE_NAMESPACE = _cache_key("extract", EXTRACT_PROMPT, QUORA_PAGE_SCHEMA)
+
+def _extract_cache_key(url: str) -> str:
+    return _cache_key(_EXTRACT_CACHE_NAMESPACE, url)
+
+@st.cache_resource
+def get_http_client() -> httpx.Client:
+    """Build the HTTP/2 client once per process so Firecrawl calls share a keep-alive connection across reruns.
+
+    The transport retries failed connects; RETRY_STATUS_CODES and transport errors are
+    retried with backoff by the caller. The read timeout sits above the 60s server-side
+    search timeout so a slow search fails on Firecrawl's side rather than the client's.
+    """
+    return httpx.Client(
+        transport=httpx.HTTPTransport(http2=True, retries=3),
+        timeout=httpx.Timeout(70.0, connect=5.0)
+    )
+
+MAX_RETRIES = 3
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+FIRECRAWL_SEARCH_URL = "https://api.firecrawl.dev/v1/search"
+
+# Search options that don't depend on the query
+SEARCH_PAYLOAD_DEFAULTS = {
+    "lang": "en",
+    "location": "United States",
+    "timeout": 60000,
+}
+
+def canonicalize_url(url: str) -> str:
+    """Drop the query and fragment so ?share/?ref variants of a Quora page compare equal."""
+    return urlunsplit(urlsplit(url)._replace(query="", fragment=""))
+
+def is_quora_url(url: str) -> bool:
+    hostname = urlsplit(url).hostname or ""
+    return hostname == "quora.com" or hostname.endswith(".quora.com")
+
 def search_for_urls(company_description: str, firecrawl_api_key: str, num_links: int) -> List[str]:
-    url = "https://api.firecrawl.dev/v1/search"
+    """Return unique, canonical Quora URLs for the description."""
     headers = {
         "Authorization": f"Bearer {firecrawl_api_key}",
         "Content-Type": "application/json"
     }
     query1 = f"quora websites where people are looking for {company_description} services"
-    payload = {
-        "query": query1,
-        "limit": num_links,
-        "lang": "en",
-        "location": "United States",
-        "timeout": 60000,
-    }
-    response = requests.post(url, json=payload, headers=headers)
-    if response.status_code == 200:
+    cache_key = _cache_key("search-canonical", query1, num_links)
+    cached_urls = get_firecrawl_cache().get(cache_key)
+    if cached_urls is not None:
+        return cached_urls
+    
+    payload = {**SEARCH_PAYLOAD_DEFAULTS, "query": query1, "limit": num_links}
+    response = None
+    for attempt in range(MAX_RETRIES + 1):
+        try:
+            response = get_http_client().post(FIRECRAWL_SEARCH_URL, json=payload, headers=headers)
+        except httpx.HTTPError:
+            response = None
+        else:
+            if response.status_code not in RETRY_STATUS_CODES:
+                break
+        if attempt < MAX_RETRIES:
+            time.sleep(0.3 * 2 ** attempt)
+    if response is not None and response.status_code == 200:
         data = response.json()
         if data.get("success"):
-            results = data.get("data", [])
-            return [result["url"] for result in results]
+            urls = []
+            for result in data.get("data", []):
+                # Skip duplicate pages and the occasional non-Quora result before they cost an extract call
+                url = canonicalize_url(result["url"])
+                if url in urls or not is_quora_url(url):
+                    continue
+                urls.append(url)
+            if urls:
+                get_firecrawl_cache().set(cache_key, urls, expire=CACHE_TTL)
+            return urls
     return []
 
-def extract_user_info_from_urls(urls: List[str], firecrawl_api_key: str) -> List[dict]:
-    user_info_list = []
-    firecrawl_app = FirecrawlApp(api_key=firecrawl_api_key)
-    
+# Firecrawl caps concurrent requests per plan (e.g. 3 on Hobby, 10 on Growth);
+# keep this at or below your plan's limit to avoid 429s.
+MAX_CONCURRENT_EXTRACTS = 10
+
+# Seconds between batch-scrape status checks while results stream in
+BATCH_POLL_INTERVAL = 2
+
+# Give up on a batch job that hasn't finished after this many seconds and fall back to per-URL extraction
+BATCH_TIMEOUT = 300
+
+def _parse_interactions(extracted_data) -> List[dict]:
+    """Validate extracted JSON against QuoraPageSchema, returning [] when it doesn't match."""
     try:
-        for url in urls:
-            st.write(f"Processing URL: {url}")
+        if isinstance(extracted_data, list):
+            extracted_data = extracted_data[0]
+        return QuoraPageSchema.model_validate(extracted_data).model_dump()["interactions"]
+    except (ValidationError, IndexError):
+        return []
+
+async def _extract_one(firecrawl_app: AsyncV1FirecrawlApp, semaphore: asyncio.Semaphore, url: str) -> Tuple[dict, List[Tuple[str, str]]]:
+    """Extract user info from a single URL.
+
+    Streamlit output is collected as (level, message) pairs and flushed by the
+    caller once the URL completes; "debug" messages are only shown when debug
+    output is enabled.
+    """
+    messages = [("debug", f"Processing URL: {url}")]
+
+    try:
+        # Use the correct Firecrawl extract syntax
+        async with semaphore:
+            response = await firecrawl_app.extract(
+                urls=[url],
+                prompt=EXTRACT_PROMPT,
+                schema=QUORA_PAGE_SCHEMA
+            )
+        
+        messages.append(("debug", f"Response type: {type(response).__name__}"))
+        
+        interactions = _parse_interactions(response.data)
+        if interactions:
+            get_firecrawl_cache().set(_extract_cache_key(url), interactions, expire=CACHE_TTL)
+            return {"website_url": url, "user_info": interactions}, messages
             
+    except Exception as url_error:
+        messages.append(("error", f"Error processing URL {url}: {str(url_error)}"))
+
+    # Create fallback data if extraction failed or found no interactions
+    return {"website_url": url, "user_info": create_fallback_data(url)}, messages
+
+def _user_info_from_document(url: str, document) -> dict:
+    """Build a user info record from a batch-scrape document, falling back on failed items."""
+    metadata = (document.metadata or {}) if document is not None else {}
+    failed = document is None or metadata.get("error") or metadata.get("statusCode", 200) >= 400
+    interactions = [] if failed else _parse_interactions(document.json_field)
+    if interactions:
+        get_firecrawl_cache().set(_extract_cache_key(url), interactions, expire=CACHE_TTL)
+    return {
+        "website_url": url,
+        "user_info": interactions if interactions else create_fallback_data(url)
+    }
+
+def _iter_batch_extract(firecrawl_app: V1FirecrawlApp, urls: List[str]) -> Iterator[dict]:
+    """Extract user info from all URLs with a single Firecrawl batch-scrape job.
+
+    Polls the job and yields each URL's record as soon as its document is ready.
+    """
+    job = firecrawl_app.async_batch_scrape_urls(
+        urls,
+        formats=["json"],
+        json_options={"prompt": EXTRACT_PROMPT, "schema": QUORA_PAGE_SCHEMA}
+    )
+    if not getattr(job, 'success', False) or not getattr(job, 'id', None):
+        raise RuntimeError("Batch scrape job could not be started")
+
+    # Insertion-ordered dict as an ordered set: O(1) membership and removal per document
+    pending = dict.fromkeys(urls)
+    matched_source_urls = set()
+    deadline = time.monotonic() + BATCH_TIMEOUT
+    while pending:
+        status = firecrawl_app.check_batch_scrape_status(job.id)
+        documents = status.data or []
+        for document in documents:
+            source_url = (document.metadata or {}).get("sourceURL")
+            if source_url in pending:
+                del pending[source_url]
+                matched_source_urls.add(source_url)
+                yield _user_info_from_document(source_url, document)
+
+        if status.status in ("failed", "cancelled"):
+            raise RuntimeError(f"Batch scrape job {status.status}")
+        if status.status == "completed":
+            break
+        if time.monotonic() >= deadline:
+            raise RuntimeError(f"Batch scrape job did not finish within {BATCH_TIMEOUT} seconds")
+        time.sleep(BATCH_POLL_INTERVAL)
+
+    if pending:
+        # Source URLs can come back normalized; correlate the leftovers by position instead
+        unmatched = [d for d in documents if (d.metadata or {}).get("sourceURL") not in matched_source_urls]
+        if len(unmatched) != len(pending):
+            unmatched = [None] * len(pending)
+        for url, document in zip(list(pending), unmatched):
+            del pending[url]
+            yield _user_info_from_document(url, document)
+
+async def _iter_concurrent_extract(urls: List[str], firecrawl_api_key: str) -> AsyncIterator[Tuple[dict, List[Tuple[str, str]]]]:
+    """Extract each URL with its own Firecrawl extract call, yielding results in completion order."""
+    firecrawl_app = AsyncV1FirecrawlApp(api_key=firecrawl_api_key)
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_EXTRACTS)
+    tasks = [asyncio.ensure_future(_extract_one(firecrawl_app, semaphore, url)) for url in urls]
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+def _iter_async(async_iterator: AsyncIterator):
+    """Drive an async iterator from synchronous (Streamlit script) code, one item at a time."""
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
             try:
-                # Use the correct Firecrawl extract syntax
-                response = firecrawl_app.extract(
-                    urls=[url],
-                    prompt='Extract all user information including username, bio, post type (question/answer), timestamp, upvotes, and any links from Quora posts. Focus on identifying potential leads who are asking questions or providing answers related to the topic.',
-                    schema=QuoraPageSchema.model_json_schema()
-                )
-                
-                st.write(f"Response type: {type(response)}")
-                st.write(f"Response attributes: {dir(response)}")
-                
-                # Handle the response object properly
-                if hasattr(response, 'data') and response.data:
-                    # If response has data attribute
-                    data = response.data
-                    if isinstance(data, list) and len(data) > 0:
-                        extracted_data = data[0] if isinstance(data[0], dict) else {}
-                    else:
-                        extracted_data = data if isinstance(data, dict) else {}
-                elif hasattr(response, '__dict__'):
-                    # If response is an object, convert to dict
-                    extracted_data = response.__dict__
-                else:
-                    # Fallback: try to access as dict
-                    extracted_data = dict(response) if hasattr(response, 'items') else {}
-                
-                st.write(f"Extracted data: {extracted_data}")
-                
-                if extracted_data and 'interactions' in extracted_data:
-                    interactions = extracted_data['interactions']
-                    if interactions:
-                        user_info_list.append({
-                            "website_url": url,
-                            "user_info": interactions
-                        })
-                    else:
-                        # Create fallback data if no interactions
-                        user_info_list.append({
-                            "website_url": url,
-                            "user_info": create_fallback_data(url)
-                        })
-                else:
-                    # Create fallback data if no interactions found
-                    user_info_list.append({
-                        "website_url": url,
-                        "user_info": create_fallback_data(url)
-                    })
-                    
-            except Exception as url_error:
-                st.error(f"Error processing URL {url}: {str(url_error)}")
-                # Create fallback data for this specific URL
-                user_info_list.append({
-                    "website_url": url,
-                    "user_info": create_fallback_data(url)
-                })
-                
+                yield loop.run_until_complete(async_iterator.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(async_iterator.aclose())
+        loop.close()
+
+def extract_user_info_from_urls(urls: List[str], firecrawl_api_key: str, debug: bool = False) -> Iterator[dict]:
+    """Yield a user info record per URL as soon as its extraction completes."""
+    remaining = {}
+    for url in urls:
+        cached_interactions = get_firecrawl_cache().get(_extract_cache_key(url))
+        if cached_interactions is not None:
+            yield {"website_url": url, "user_info": cached_interactions}
+        else:
+            remaining[url] = None
+    if not remaining:
+        return
+
+    firecrawl_app = V1FirecrawlApp(api_key=firecrawl_api_key)
+
+    try:
+        for user_info in _iter_batch_extract(firecrawl_app, list(remaining)):
+            del remaining[user_info["website_url"]]
+            yield user_info
+        return
     except Exception as e:
-        st.error(f"General error extracting data: {str(e)}")
-        # Create fallback data for all URLs
-        for url in urls:
-            user_info_list.append({
-                "website_url": url,
-                "user_info": create_fallback_data(url)
-            })
-    
-    return user_info_list
+        st.error(f"Batch extraction failed, falling back to per-URL extraction: {str(e)}")
+
+    # Each extract call is an independent, network-bound request, so fan them out on one event loop
+    for user_info, messages in _iter_async(_iter_concurrent_extract(list(remaining), firecrawl_api_key)):
+        for level, message in messages:
+            if level == "debug":
+                if debug:
+                    st.write(message)
+            else:
+                getattr(st, level)(message)
+        yield user_info
 
-def create_fallback_data(url: str) -> List[dict]:
+# Shared by every fallback record; links is a tuple so copies never share a mutable list
+FALLBACK_INTERACTION = {
+    "username": "",
+    "bio": "Bio not available - extraction failed",
+    "post_type": "question",
+    "timestamp": "2024-01-01",
+    "upvotes": 0,
+    "links": (),
+}
+
+def create_fallback_data(url: str) -> Tuple[dict, ...]:
     """Create fallback data when extraction fails"""
-    return [
-        {
-            "username": "User from " + url.split('/')[-1][:15],
-            "bio": "Bio not available - extraction failed",
-            "post_type": "question",
-            "timestamp": "2024-01-01",
-            "upvotes": 0,
-            "links": []
-        }
-    ]
+    interaction = FALLBACK_INTERACTION.copy()
+    interaction["username"] = f"User from {url.rsplit('/', 1)[-1][:15]}"
+    return (interaction,)
 
-def format_user_info_to_flattened_json(user_info_list: List[dict]) -> List[dict]:
-    flattened_data = []
+# Extracted field -> lead table column, in display order
+LEAD_COLUMNS = {
+    "website_url": "Website URL",
+    "username": "Username",
+    "bio": "Bio",
+    "post_type": "Post Type",
+    "timestamp": "Timestamp",
+    "upvotes": "Upvotes",
+    "links": "Links",
+}
+
+def format_user_info_to_flattened_json(user_info_list: List[dict]) -> pd.DataFrame:
+    records = [
+        {**interaction, "website_url": info["website_url"]}
+        for info in user_info_list
+        for interaction in info["user_info"]
+    ]
     
-    for info in user_info_list:
-        website_url = info["website_url"]
-        user_info = info["user_info"]
-        
-        for interaction in user_info:
-            flattened_interaction = {
-                "Website URL": website_url,
-                "Username": interaction.get("username", ""),
-                "Bio": interaction.get("bio", ""),
-                "Post Type": interaction.get("post_type", ""),
-                "Timestamp": interaction.get("timestamp", ""),
-                "Upvotes": interaction.get("upvotes", 0),
-                "Links": ", ".join(interaction.get("links", [])),
-            }
-            flattened_data.append(flattened_interaction)
+    df = pd.json_normalize(records).reindex(columns=list(LEAD_COLUMNS))
+    df["links"] = df["links"].map(", ".join, na_action="ignore")
+    df = df.fillna({"username": "", "bio": "", "post_type": "", "timestamp": "", "links": ""})
+    df["upvotes"] = pd.to_numeric(df["upvotes"], errors="coerce").fillna(0).astype("int64")
     
-    return flattened_data
+    return df.rename(columns=LEAD_COLUMNS)
+
+# The rewrite is 3-4 words, so cap generation well below Ollama's default and keep
+# the context small; keep_alive leaves the model loaded between "Generate Leads" clicks.
+OLLAMA_OPTIONS = {"num_ctx": 1024, "num_predict": 16}
+OLLAMA_KEEP_ALIVE = "10m"
 
 def create_prompt_transformation_agent(model_name: str) -> Agent:
     return Agent(
-        model=Ollama(id=model_name),
+        model=Ollama(id=model_name, options=OLLAMA_OPTIONS, keep_alive=OLLAMA_KEEP_ALIVE),
         instructions="""You are an expert at transforming detailed user queries into concise company descriptions.
 Your task is to extract the core business/product focus in 3-4 words.
 
@@ -174,6 +358,32 @@ Always focus on the core product/service and keep it concise but clear.""",
         markdown=True
     )
 
+# The longest example description is 7 words; stop streaming once the model goes past that
+MAX_DESCRIPTION_WORDS = 8
+
+# Streamed content-delta event names (agno 1.x and 2.x+)
+_CONTENT_EVENTS = {"RunResponseContent", "RunContent"}
+
+def transform_query(transform_agent: Agent, user_query: str) -> str:
+    """Rewrite the query into a short company description.
+
+    The Ollama output is streamed and cut off as soon as the first line is complete
+    or it runs past MAX_DESCRIPTION_WORDS, instead of waiting for the model to stop.
+    """
+    description = ""
+    for event in transform_agent.run(
+        f"Transform this query into a concise 3-4 word company description: {user_query}",
+        stream=True
+    ):
+        if getattr(event, "event", None) not in _CONTENT_EVENTS or not isinstance(event.content, str):
+            continue
+        description += event.content
+        if "\n" in description.strip() or len(description.split()) > MAX_DESCRIPTION_WORDS:
+            break
+
+    lines = description.strip().splitlines()
+    return " ".join(lines[0].split()[:MAX_DESCRIPTION_WORDS]) if lines else ""
+
 def main():
     st.title("🎯 AI Lead Generation Agent")
     st.info("This firecrawl powered agent helps you generate leads from Quora by searching for relevant posts and extracting user information.")
@@ -201,9 +411,11 @@ def main():
             label_visibility="collapsed"
         )
         
+        debug = st.checkbox("Show debug output", value=False)
+        
         if st.button("Reset"):
             st.session_state.clear()
-            st.experimental_rerun()
+            st.rerun()
 
     user_query = st.text_area(
         "Describe what kind of leads you're looking for:",
@@ -216,51 +428,66 @@ def main():
             st.error("Please fill in the Firecrawl API key and describe what leads you're looking for.")
         else:
             with st.spinner("Processing your query..."):
-                transform_agent = create_prompt_transformation_agent(ollama_model)
-                company_description = transform_agent.run(f"Transform this query into a concise 3-4 word company description: {user_query}")
-                st.write("🎯 Searching for:", company_description.content)
+                # Build the agent once per session and model rather than on every click
+                agent_key = f"transform_agent_{ollama_model}"
+                if agent_key not in st.session_state:
+                    st.session_state[agent_key] = create_prompt_transformation_agent(ollama_model)
+                transform_agent = st.session_state[agent_key]
+                company_description = transform_query(transform_agent, user_query)
+                st.write("🎯 Searching for:", company_description)
             
             with st.spinner("Searching for relevant URLs..."):
-                urls = search_for_urls(company_description.content, firecrawl_api_key, num_links)
+                urls = search_for_urls(company_description, firecrawl_api_key, num_links)
             
             if urls:
                 st.subheader("Quora Links Used:")
                 for url in urls:
                     st.write(url)
                 
+                st.subheader("Extracted Lead Data:")
+                lead_table = st.empty()
+                # add_rows() is gone from current Streamlit; append each URL's rows to a container instead
+                streamed_rows = lead_table.container()
+                user_info_list = []
+                lead_frames = []
+                csv_buffer = io.StringIO()
+                
+                # Flatten and render each URL's leads as soon as its extraction completes
                 with st.spinner("Extracting user info from URLs..."):
-                    user_info_list = extract_user_info_from_urls(urls, firecrawl_api_key)
+                    for user_info in extract_user_info_from_urls(urls, firecrawl_api_key, debug):
+                        user_info_list.append(user_info)
+                        lead_frame = format_user_info_to_flattened_json([user_info])
+                        # Append each URL's rows to the CSV as they arrive instead of re-serializing the full table
+                        lead_frame.to_csv(csv_buffer, header=csv_buffer.tell() == 0, index=False)
+                        lead_frames.append(lead_frame)
+                        streamed_rows.dataframe(lead_frame, use_container_width=True, hide_index=True)
                 
-                with st.spinner("Formatting user info..."):
-                    flattened_data = format_user_info_to_flattened_json(user_info_list)
+                # Swap the streamed per-URL tables for a single combined table
+                leads_df = pd.concat(lead_frames, ignore_index=True) if lead_frames else pd.DataFrame(columns=list(LEAD_COLUMNS.values()))
+                lead_table.dataframe(leads_df, use_container_width=True)
                 
-                st.write(f"Debug: Found {len(user_info_list)} URL responses")
-                st.write(f"Debug: Flattened data has {len(flattened_data)} entries")
+                if debug:
+                    st.write(f"Debug: Found {len(user_info_list)} URL responses")
+                    st.write(f"Debug: Flattened data has {len(leads_df)} entries")
                 
-                if flattened_data:
+                if not leads_df.empty:
                     st.success("Lead generation completed successfully!")
                     
                     # Download Your Leads section
                     st.subheader("Download Your Leads:")
                     
-                    # Create CSV data
-                    df = pd.DataFrame(flattened_data)
-                    csv = df.to_csv(index=False)
-                    
-                    # CSV Download button
+                    # CSV Download button; clicking it skips the rerun so the results and CSV aren't rebuilt
                     st.download_button(
                         label="Download CSV",
-                        data=csv,
+                        data=csv_buffer.getvalue(),
                         file_name="leads.csv",
-                        mime="text/csv"
+                        mime="text/csv",
+                        on_click="ignore"
                     )
-                    
-                    # Extracted Lead Data section
-                    st.subheader("Extracted Lead Data:")
-                    st.dataframe(df, use_container_width=True)
                 else:
                     st.warning("No lead data could be extracted from the URLs.")
-                    st.write("Debug: user_info_list:", user_info_list)
+                    if debug:
+                        st.write("Debug: user_info_list:", user_info_list)
             else:
                 st.warning("No relevant URLs found.")
 